@@ -215,7 +215,7 @@ prepare_dataset() {
     print_status "Installing required Python packages..."
     source $VENV_DIR/bin/activate
     pip install --upgrade pip
-    pip install datasets google-cloud-storage tensorflow transformers array-record grain
+    pip install datasets transformers google-cloud-storage numpy pandas tqdm
     
     # Use a reasonable number of samples for demo
     NUM_SAMPLES=${NUM_SAMPLES:-500}
@@ -226,7 +226,7 @@ prepare_dataset() {
     # Run ArrayRecord data preparation locally
     python scripts/prepare_arrayrecord_data.py \
         --gcs_bucket $DATASETS_BUCKET \
-        --gcs_path train_data.array_record \
+        --gcs_path train_data \
         --num_samples $NUM_SAMPLES \
         --tokenizer_name google/gemma-2-27b
     
@@ -5,18 +5,33 @@ This script demonstrates how to interact with the fine-tuned Gemma-2-27B model.
 """
 
 import requests
-import json
+import orjson
 import argparse
+import asyncio
+import os
 import time
 import sys
 from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def get_service_ip(service_name: str = "vllm-gemma-service") -> str:
-    """Get the external IP of the Kubernetes service."""
+# Shared session so every call reuses pooled keep-alive connections instead
+# of paying TCP (and TLS) setup per request
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                     max_retries=Retry(total=3, backoff_factor=0.3)))
+SESSION.headers.update({"Content-Type": "application/json"})
+
+CACHE_DIR = os.path.expanduser("~/.cache/maxtext-demo")
+SERVICE_IP_TTL_SECONDS = 300
+
+def _lookup_service_ip_kubectl(service_name: str) -> str:
+    """Fall back to forking the kubectl CLI for the service IP."""
     import subprocess
     try:
         result = subprocess.run([
-            "kubectl", "get", "service", service_name, 
+            "kubectl", "get", "service", service_name,
             "-o", "jsonpath={.status.loadBalancer.ingress[0].ip}"
         ], capture_output=True, text=True, check=True)
         return result.stdout.strip()
@@ -25,10 +40,43 @@ def get_service_ip(service_name: str = "vllm-gemma-service") -> str:
         print("Make sure the service is deployed and has an external IP")
         return None
 
+def _lookup_service_ip(service_name: str) -> str:
+    """Resolve the service IP via the Kubernetes API client when available."""
+    try:
+        from kubernetes import client, config
+    except ImportError:
+        return _lookup_service_ip_kubectl(service_name)
+    try:
+        # One HTTP call against the cluster API, no process fork
+        config.load_kube_config()
+        service = client.CoreV1Api().read_namespaced_service(service_name, "default")
+        return service.status.load_balancer.ingress[0].ip
+    except Exception:
+        return _lookup_service_ip_kubectl(service_name)
+
+def get_service_ip(service_name: str = "vllm-gemma-service") -> str:
+    """Get the external IP of the Kubernetes service, cached on disk with a short TTL."""
+    cache_file = os.path.join(CACHE_DIR, f"service-ip-{service_name}")
+    try:
+        if time.time() - os.path.getmtime(cache_file) < SERVICE_IP_TTL_SECONDS:
+            with open(cache_file) as f:
+                cached_ip = f.read().strip()
+            if cached_ip:
+                return cached_ip
+    except OSError:
+        pass
+
+    ip = _lookup_service_ip(service_name)
+    if ip:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_file, 'w') as f:
+            f.write(ip)
+    return ip
+
 def test_health(base_url: str) -> bool:
     """Test the health endpoint."""
     try:
-        response = requests.get(f"{base_url}/health", timeout=10)
+        response = SESSION.get(f"{base_url}/health", timeout=10)
         if response.status_code == 200:
             print("✅ Health check passed")
             return True
@@ -42,7 +90,7 @@ def test_health(base_url: str) -> bool:
 def list_models(base_url: str) -> Dict[str, Any]:
     """List available models."""
     try:
-        response = requests.get(f"{base_url}/v1/models", timeout=10)
+        response = SESSION.get(f"{base_url}/v1/models", timeout=10)
         if response.status_code == 200:
             models = response.json()
             print("✅ Available models:")
@@ -56,77 +104,111 @@ def list_models(base_url: str) -> Dict[str, Any]:
         print(f"❌ Failed to list models: {e}")
         return {}
 
-def generate_text(base_url: str, prompt: str, model: str = "gemma-2-27b-finetuned", 
-                 max_tokens: int = 200, temperature: float = 0.7) -> str:
-    """Generate text using the completion endpoint."""
+def generate_text(base_url: str, prompt: str, model: str = "gemma-2-27b-finetuned",
+                 max_tokens: int = 200, temperature: float = 0.7,
+                 stream_output: bool = True) -> str:
+    """
+    Generate text using the completion endpoint, streaming tokens as they arrive.
+
+    Pass stream_output=False when several calls share stdout (e.g. concurrent
+    demo prompts) so their token streams don't interleave; the caller prints
+    the returned text instead.
+    """
     payload = {
         "model": model,
         "prompt": prompt,
         "max_tokens": max_tokens,
         "temperature": temperature,
-        "stop": ["\n\n", "###"]
+        "stop": ["\n\n", "###"],
+        "stream": True
     }
-    
+
     try:
         print(f"🤖 Generating response for: '{prompt[:50]}...'")
         start_time = time.time()
-        
-        response = requests.post(
+
+        with SESSION.post(
             f"{base_url}/v1/completions",
-            headers={"Content-Type": "application/json"},
             json=payload,
+            stream=True,
             timeout=60
-        )
-        
+        ) as response:
+            if response.status_code != 200:
+                print(f"❌ Generation failed: {response.status_code}")
+                print(f"Response: {response.text}")
+                return ""
+
+            # Consume the SSE stream, printing each token as it is generated
+            pieces = []
+            if stream_output:
+                print("📝 ", end="", flush=True)
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[len(b"data: "):]
+                if data == b"[DONE]":
+                    break
+                chunk = orjson.loads(data)
+                token = chunk["choices"][0].get("text", "")
+                pieces.append(token)
+                if stream_output:
+                    print(token, end="", flush=True)
+            if stream_output:
+                print()
+
         end_time = time.time()
-        
-        if response.status_code == 200:
-            result = response.json()
-            generated_text = result["choices"][0]["text"]
-            print(f"✅ Generated text in {end_time - start_time:.2f}s:")
-            print(f"📝 {generated_text}")
-            return generated_text
-        else:
-            print(f"❌ Generation failed: {response.status_code}")
-            print(f"Response: {response.text}")
-            return ""
+        generated_text = "".join(pieces)
+        print(f"✅ Generated text in {end_time - start_time:.2f}s")
+        return generated_text
     except requests.RequestException as e:
         print(f"❌ Generation failed: {e}")
         return ""
 
 def chat_completion(base_url: str, messages: list, model: str = "gemma-2-27b-finetuned",
                    max_tokens: int = 200, temperature: float = 0.7) -> str:
-    """Generate text using the chat completion endpoint."""
+    """Generate text using the chat completion endpoint, streaming the reply."""
     payload = {
         "model": model,
         "messages": messages,
         "max_tokens": max_tokens,
-        "temperature": temperature
+        "temperature": temperature,
+        "stream": True
     }
-    
+
     try:
         print(f"💬 Sending chat message...")
         start_time = time.time()
-        
-        response = requests.post(
+
+        with SESSION.post(
             f"{base_url}/v1/chat/completions",
-            headers={"Content-Type": "application/json"},
             json=payload,
+            stream=True,
             timeout=60
-        )
-        
+        ) as response:
+            if response.status_code != 200:
+                print(f"❌ Chat completion failed: {response.status_code}")
+                print(f"Response: {response.text}")
+                return ""
+
+            # Consume the SSE stream, printing each delta as it is generated
+            pieces = []
+            print("🤖 ", end="", flush=True)
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[len(b"data: "):]
+                if data == b"[DONE]":
+                    break
+                chunk = orjson.loads(data)
+                token = chunk["choices"][0].get("delta", {}).get("content", "")
+                pieces.append(token)
+                print(token, end="", flush=True)
+            print()
+
         end_time = time.time()
-        
-        if response.status_code == 200:
-            result = response.json()
-            generated_text = result["choices"][0]["message"]["content"]
-            print(f"✅ Generated response in {end_time - start_time:.2f}s:")
-            print(f"🤖 {generated_text}")
-            return generated_text
-        else:
-            print(f"❌ Chat completion failed: {response.status_code}")
-            print(f"Response: {response.text}")
-            return ""
+        generated_text = "".join(pieces)
+        print(f"✅ Generated response in {end_time - start_time:.2f}s")
+        return generated_text
     except requests.RequestException as e:
         print(f"❌ Chat completion failed: {e}")
         return ""
@@ -142,33 +224,104 @@ def run_demo_prompts(base_url: str):
     
     print("\n🚀 Running demo prompts...")
     print("=" * 60)
-    
-    for i, prompt in enumerate(demo_prompts, 1):
-        print(f"\n📋 Demo {i}/{len(demo_prompts)}")
-        print("-" * 40)
-        generate_text(base_url, prompt, max_tokens=150, temperature=0.7)
-        
-        if i < len(demo_prompts):
-            print("\nWaiting 2 seconds before next prompt...")
-            time.sleep(2)
-
-def interactive_mode(base_url: str):
+
+    # Send all prompts at once; vLLM batches concurrent requests server-side,
+    # so this finishes in roughly the time of the slowest single prompt.
+    # Token streaming is disabled so the parallel responses don't interleave
+    # on stdout; each result is printed whole as its future completes.
+    with ThreadPoolExecutor(max_workers=len(demo_prompts)) as executor:
+        futures = {executor.submit(generate_text, base_url, prompt, max_tokens=150,
+                                   temperature=0.7, stream_output=False): prompt
+                   for prompt in demo_prompts}
+        for i, future in enumerate(as_completed(futures), 1):
+            prompt = futures[future]
+            generated_text = future.result()
+            print(f"\n📋 Demo {i}/{len(demo_prompts)}: '{prompt[:50]}...'")
+            print("-" * 40)
+            print(f"📝 {generated_text}")
+
+async def _generate_text_async(client, base_url: str, prompt: str,
+                               model: str = "gemma-2-27b-finetuned",
+                               max_tokens: int = 200, temperature: float = 0.7) -> str:
+    """Stream a completion over the shared async HTTP/2 connection."""
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stop": ["\n\n", "###"],
+        "stream": True
+    }
+
+    import httpx
+
+    pieces = []
+    try:
+        async with client.stream("POST", f"{base_url}/v1/completions", json=payload) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                print(f"❌ Generation failed: {response.status_code}")
+                print(f"Response: {body.decode(errors='replace')}")
+                return ""
+
+            print("📝 ", end="", flush=True)
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                token = orjson.loads(data)["choices"][0].get("text", "")
+                pieces.append(token)
+                print(token, end="", flush=True)
+            print()
+    except httpx.HTTPError as e:
+        print(f"\n❌ Generation failed: {e}")
+        return ""
+    return "".join(pieces)
+
+async def _finish_pending(task):
+    """Await an in-flight generation without letting its failure end the session."""
+    try:
+        await task
+    except Exception as e:
+        print(f"\n❌ Generation failed: {e}")
+
+async def interactive_mode(base_url: str):
     """Interactive mode for chatting with the model."""
+    import httpx
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.patch_stdout import patch_stdout
+
     print("\n💬 Interactive mode - Type 'quit' to exit")
     print("=" * 50)
-    
-    while True:
-        try:
-            prompt = input("\n👤 You: ").strip()
+
+    prompt_session = PromptSession()
+    pending = None
+    # One multiplexed HTTP/2 connection; prompt input and token streaming run
+    # concurrently on the event loop, so you can type while output renders
+    async with httpx.AsyncClient(http2=True, timeout=60) as client:
+        while True:
+            try:
+                with patch_stdout():
+                    prompt = (await prompt_session.prompt_async("\n👤 You: ")).strip()
+            except (EOFError, KeyboardInterrupt):
+                print("👋 Goodbye!")
+                break
+
             if prompt.lower() in ['quit', 'exit', 'q']:
                 print("👋 Goodbye!")
                 break
-            
-            if prompt:
-                generate_text(base_url, prompt, max_tokens=200, temperature=0.7)
-        except KeyboardInterrupt:
-            print("\n👋 Goodbye!")
-            break
+            if not prompt:
+                continue
+
+            # Let any still-streaming response finish before sending the next;
+            # a failed request shouldn't take down the whole session
+            if pending:
+                await _finish_pending(pending)
+            pending = asyncio.create_task(_generate_text_async(client, base_url, prompt))
+        if pending:
+            await _finish_pending(pending)
 
 def main():
     parser = argparse.ArgumentParser(description="Test the vLLM API endpoint")
@@ -213,7 +366,7 @@ def main():
         run_demo_prompts(base_url)
     
     elif args.mode == "interactive":
-        interactive_mode(base_url)
+        asyncio.run(interactive_mode(base_url))
     
     print(f"\n✅ Testing completed!")
 